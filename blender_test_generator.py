@@ -6,17 +6,44 @@ should also have the same name for diffuse textures, and use suffixes for other
 maps (ao, roughness, etc.).
 
 Usage (command line):
-    $ blender -b -P blender_test_generator.py
+    $ blender -b -P blender_test_generator.py [-- file.obj [file.obj ...]]
+
+    Without any files the pumpkin test asset is rendered to render.jpg.
+    Otherwise each file is rendered to <name>.jpg, using one background
+    Blender process per file when more than one is given. Files with the same
+    name get a number appended (<name>_2.jpg). Renders are saved next to this
+    script. The exit code is 1 if any file failed to import or render.
+
+    When run from the UI only the first file is imported.
+
+    Set BLENDER_PREVIEW=1 for a quick, low sample render without compositing.
+
+    The first command line run saves the scene, render and compositing setup
+    to template.blend next to this script, and later runs open it instead of
+    rebuilding everything. It is rebuilt whenever this script is newer.
 
 Requires:
-    - Blender 2.79
-    - The "Import-Export: Wavefront OBJ" addon enabled
+    - Blender 2.79 (uses the numpy module bundled with it)
 
 """
 
 import os
-import glob
-import bpy
+import re
+import sys
+import functools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Only available inside Blender. Guarded so the helpers that don't need it
+# can be imported from a plain Python interpreter
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+
+# Texture maps that are currently wired into the material
+_MAP_TYPES = ('diffuse', 'ao')
 
 
 class Asset():
@@ -28,9 +55,24 @@ class Asset():
         self.filepath = filepath
         print('- Importing OBJ file: {}'.format(filepath))
 
-        bpy.ops.import_scene.obj(filepath=filepath)
-        self.object = bpy.context.selected_objects[0]
         self.name = os.path.splitext(os.path.basename(filepath))[0]
+        self.object = load_obj_fast(filepath, self.name, bpy.context.scene)
+        self.textures = find_textures(os.path.dirname(filepath), self.name)
+
+        # Files and modification times the material was built from
+        self.source = repr([filepath] + sorted(
+            (tex_path, os.path.getmtime(tex_path))
+            for tex_path in self.textures.values()))
+
+        # Reuse the material if this same file was already imported, and its
+        # textures haven't changed since. Look it up by source rather than
+        # name, since it may have been numbered (pumpkin.001) on creation
+        material = next((mat for mat in bpy.data.materials
+                         if mat.get('source') == self.source), None)
+        if material is not None:
+            self.material = material
+            self.object.data.materials.append(material)
+            return
 
         # Make material
         self.make_material()
@@ -41,96 +83,130 @@ class Asset():
 
         # Make a new material
         self.material = bpy.data.materials.new(self.name)
+        self.material['source'] = self.source
         self.material.use_nodes = True
-        self.mat_nodes = self.material.node_tree.nodes
-        self.mat_links = self.material.node_tree.links
+        node_tree = self.material.node_tree
+        nodes = self.mat_nodes = node_tree.nodes
+        links = self.mat_links = node_tree.links
 
-        self.object.data.materials[0] = self.material
+        self.object.data.materials.append(self.material)
 
         # Switch diffuse to principled shader
-        location = self.mat_nodes['Diffuse BSDF'].location.copy()
-        output = self.mat_nodes['Material Output']
-        self.mat_nodes.remove(self.mat_nodes['Diffuse BSDF'])
-        principled = self.mat_nodes.new('ShaderNodeBsdfPrincipled')
+        diffuse_node = nodes['Diffuse BSDF']
+        location = diffuse_node.location.copy()
+        output_surface = nodes['Material Output'].inputs['Surface']
+        nodes.remove(diffuse_node)
+        principled = nodes.new('ShaderNodeBsdfPrincipled')
         principled.location = location
 
         # NOTE: Hardcoded, but this should come from a map
         principled.inputs['Subsurface'].default_value = 0.1
 
-        self.mat_links.new(principled.outputs['BSDF'],
-                           output.inputs['Surface'])
+        links.new(principled.outputs['BSDF'], output_surface)
 
         self.principled = principled
 
-    def make_image_node(self, image_path):
-        """Make an image node."""
+    def make_image_node(self, image):
+        """Make an image node for an already loaded image."""
 
-        image = bpy.data.images.load(image_path, check_existing=False)
         node_image = self.mat_nodes.new(type='ShaderNodeTexImage')
         node_image.image = image
 
         return node_image
 
     def set_textures(self):
-        """Find textures in the OBJ file's folder and add to material."""
+        """Add the textures found in the OBJ file's folder to material."""
 
-        def map_type(texture):
-            """Return type of texture by finding its suffix."""
+        textures = self.textures
 
-            name = os.path.splitext((os.path.basename(texture)))[0].lower()
-            suffix = name.partition('_')[2]
+        if not textures:
+            print('[!] No textures found!')
+            return
 
-            return suffix or 'diffuse'
+        print('Found textures {}'.format(textures))
 
-        # Find textures
-        folder = os.path.dirname(self.filepath) + os.path.sep
-        found_textures = glob.glob(folder + self.name + '*.jpg')
+        # Load all images up front, reusing any already in the blend data
+        images = {}
+        for tex_type, tex_path in textures.items():
+            image = bpy.data.images.load(tex_path, check_existing=True)
 
-        if not any(found_textures):
-            print('[!] No textures found!')
-            return
+            # An existing image may be outdated if the file changed
+            mtime = os.path.getmtime(tex_path)
+            if image.get('mtime', mtime) != mtime:
+                image.reload()
+            image['mtime'] = mtime
 
-        # Organize by type
-        tex_types = [map_type(t) for t in found_textures]
-        textures = dict(zip(tex_types, found_textures))
+            images[tex_type] = image
 
-        print('Found textures {}'.format(textures))
+        nodes = self.mat_nodes
+        links = self.mat_links
+        base_color_in = self.principled.inputs['Base Color']
+        px, py = self.principled.location
 
         # Make diffuse image node
-        diffuse = self.make_image_node(textures['diffuse'])
-        diffuse.location = self.principled.location
-        diffuse.location.x -= 750
+        diffuse = self.make_image_node(images['diffuse'])
+        diffuse.location = (px - 750, py)
         diffuse.name = 'Diffuse Map'
 
         # Ambient Occlusion has to be mixed with the diffuse map
         if 'ao' in textures:
-            ao = self.make_image_node(textures['ao'])
-            ao.location = self.principled.location
-            ao.location.x -= 500
+            ao = self.make_image_node(images['ao'])
+            ao.location = (px - 500, py)
             ao.name = 'Ambient Occlusion Map'
 
-            mix = self.mat_nodes.new('ShaderNodeMixRGB')
+            mix = nodes.new('ShaderNodeMixRGB')
             mix.name = 'Apply Ambient Occlusion'
             mix.blend_type = 'MULTIPLY'
-            mix.location = self.principled.location
-            mix.location.x -= 250
+            mix.location = (px - 250, py)
             mix.inputs['Fac'].default_value = 1
 
-            self.mat_links.new(diffuse.outputs['Color'], mix.inputs['Color1'])
-            self.mat_links.new(ao.outputs['Color'], mix.inputs['Color2'])
-            self.mat_links.new(mix.outputs['Color'],
-                               self.principled.inputs['Base Color'])
+            links.new(diffuse.outputs['Color'], mix.inputs['Color1'])
+            links.new(ao.outputs['Color'], mix.inputs['Color2'])
+            links.new(mix.outputs['Color'], base_color_in)
 
         # Otherwise, we can just plug the diffuse into the principled shader
         else:
-            self.mat_links.new(diffuse.outputs['Color'],
-                               self.principled.inputs['Base Color'])
+            links.new(diffuse.outputs['Color'], base_color_in)
 
 
+def find_textures(folder, name):
+    """Return the textures for asset `name` in `folder`, keyed by map type.
+
+    "name.jpg" is the diffuse map and "name_<type>.jpg" are the other maps.
+    Only the map types in _MAP_TYPES are returned.
+    """
+
+    textures = {}
+    prefix = name + '_'
+    for entry in os.scandir(folder):
+        stem, ext = os.path.splitext(entry.name)
+        if ext.lower() != '.jpg':
+            continue
+
+        if stem == name:
+            tex_type = 'diffuse'
+        elif stem.startswith(prefix):
+            tex_type = stem[len(prefix):].lower()
+        else:
+            continue
+
+        if tex_type in _MAP_TYPES:
+            textures[tex_type] = entry.path
+
+            if len(textures) == len(_MAP_TYPES):
+                break
+
+    return textures
+
+
+@functools.lru_cache(maxsize=128)
 def path(*paths):
-    """Return a  relative path from the script."""
+    """Return a  relative path from the script.
 
-    if bpy.app.background:
+    The base folder can't change during a run, so results are cached.
+    """
+
+    if bpy is None or bpy.app.background:
         base = os.path.dirname(__file__)
     else:
         base = os.path.dirname(bpy.path.abspath('//'))
@@ -138,6 +214,152 @@ def path(*paths):
     return os.path.join(base, *paths)
 
 
+def load_obj_fast(filepath, name, scene):
+    """Load an OBJ file's geometry, UVs and normals, and link it to the scene.
+
+    This is a lot faster than the OBJ import addon for big meshes, but only
+    handles a single object and ignores groups and materials. Raises a
+    RuntimeError if the file can't be parsed.
+    """
+
+    import numpy as np
+
+    with open(filepath, 'rb') as obj_file:
+        data = obj_file.read()
+
+    def lines(prefix):
+        """Return the start offsets and contents of all `prefix` lines.
+
+        Trailing comments are not part of the contents.
+        """
+
+        found = list(re.finditer(rb'(?m)^' + prefix + rb'[ \t]+([^#\r\n]*)',
+                                 data))
+        offsets = np.array([line.start() for line in found], dtype=np.int64)
+
+        return offsets, [line.group(1) for line in found]
+
+    def as_array(rows, dtype, width=None):
+        """Parse whitespace separated rows, using the first row's width."""
+
+        if not rows:
+            raise RuntimeError('Missing data in {}'.format(filepath))
+
+        width = width or len(rows[0].split())
+        block = np.fromstring(b' '.join(rows), dtype=dtype, sep=' ')
+
+        try:
+            return block.reshape(-1, width)
+        except ValueError:
+            raise RuntimeError('Inconsistent rows in {}'.format(filepath))
+
+    def to_blender_axes(vectors):
+        """Convert from OBJ's Y up to Blender's Z up."""
+
+        return vectors[:, (0, 2, 1)] * (1, -1, 1)
+
+    v_offsets, v_lines = lines(b'v')
+    f_offsets, f_lines = lines(b'f')
+
+    if not v_lines or not f_lines:
+        raise RuntimeError('No geometry found in {}'.format(filepath))
+
+    # Vertices can have an extra w or r g b values, only keep x y z
+    verts = to_blender_axes(as_array(v_lines, np.float32)[:, :3])
+
+    # Faces are a list of "v", "v/vt", "v//vn" or "v/vt/vn" corners, which
+    # can be mixed in the same file. Missing indices are filled in with 0
+    sizes = np.array([len(line.split()) for line in f_lines])
+    corners = re.findall(rb'(-?\d+)(?:/(-?\d*))?(?:/(-?\d*))?',
+                         b' '.join(f_lines))
+
+    if len(corners) != sizes.sum():
+        raise RuntimeError('Invalid faces in {}'.format(filepath))
+
+    indices = np.array(corners)
+    indices[indices == b''] = b'0'
+    indices = indices.astype(np.int64)
+
+    has_uvs = (indices[:, 1] != 0).any()
+    has_normals = (indices[:, 2] != 0).any()
+
+    def resolve(column, offsets, values):
+        """Return the values a column of indices points to.
+
+        Corners without an index for this column get zeros.
+        """
+
+        raw = indices[:, column]
+        if (raw > 0).all():
+            resolved = raw - 1
+        else:
+            # Negative indices count back from the last element defined
+            # before the face
+            defined = np.searchsorted(offsets, f_offsets).repeat(sizes)
+            resolved = np.where(raw < 0, raw + defined, raw - 1)
+
+        missing = raw == 0
+        used = resolved[~missing]
+        if ((used < 0) | (used >= len(values))).any():
+            raise RuntimeError('Invalid face indices in {}'.format(filepath))
+
+        resolved = values[resolved.clip(0, len(values) - 1)]
+        resolved[missing] = 0
+
+        return resolved
+
+    if (indices[:, 0] == 0).any():
+        raise RuntimeError('Invalid face indices in {}'.format(filepath))
+
+    vert_indices = resolve(0, v_offsets, np.arange(len(verts)))
+    if (sizes == sizes[0]).all():
+        faces = vert_indices.reshape(-1, sizes[0]).tolist()
+    else:
+        faces = [f.tolist() for f in
+                 np.split(vert_indices, np.cumsum(sizes)[:-1])]
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(verts.tolist(), [], faces)
+
+    if has_uvs:
+        vt_offsets, vt_lines = lines(b'vt')
+        uvs = as_array(vt_lines, np.float32)[:, :2]
+
+        mesh.uv_textures.new()
+        mesh.uv_layers[0].data.foreach_set(
+            'uv', resolve(1, vt_offsets, uvs).ravel())
+
+    if has_normals:
+        vn_offsets, vn_lines = lines(b'vn')
+        normals = to_blender_axes(as_array(vn_lines, np.float32))
+
+        mesh.create_normals_split()
+        mesh.loops.foreach_set(
+            'normal', resolve(2, vn_offsets, normals).ravel())
+
+    # Clean up invalid geometry (e.g. faces with less than three corners),
+    # keeping the UVs and normals in line with the remaining loops
+    mesh.validate(clean_customdata=False)
+
+    if has_normals:
+        # Same as the addon, per corner normals become custom split normals
+        loop_normals = np.empty(len(mesh.loops) * 3, dtype=np.float32)
+        mesh.loops.foreach_get('normal', loop_normals)
+
+        mesh.polygons.foreach_set('use_smooth', [True] * len(mesh.polygons))
+        mesh.normals_split_custom_set(loop_normals.reshape(-1, 3).tolist())
+        mesh.use_auto_smooth = True
+    elif re.search(rb'(?m)^s +(1|on)\s*$', data):
+        mesh.polygons.foreach_set('use_smooth', [True] * len(mesh.polygons))
+
+    mesh.update()
+
+    obj = bpy.data.objects.new(name, mesh)
+    scene.objects.link(obj)
+
+    return obj
+
+
 def setup_scene(scene):
     """Setup world and lighting for the scene."""
 
@@ -145,9 +367,14 @@ def setup_scene(scene):
     for obj in bpy.data.objects:
         bpy.data.objects.remove(bpy.data.objects[obj.name], do_unlink=True)
 
-    # Setup test table
-    bpy.ops.mesh.primitive_plane_add(radius=6)
-    plane = bpy.context.selected_objects[0]
+    # Setup test table. Build it directly from data instead of using
+    # bpy.ops so no operator update runs before the asset is imported
+    plane_mesh = bpy.data.meshes.new('Plane')
+    plane_mesh.from_pydata(
+        [(-6, -6, 0), (6, -6, 0), (6, 6, 0), (-6, 6, 0)], [], [(0, 1, 2, 3)])
+    plane_mesh.update()
+    plane = bpy.data.objects.new('Plane', plane_mesh)
+    scene.objects.link(plane)
 
     # Setup camera
     camera = bpy.data.cameras.new("Camera")
@@ -190,7 +417,6 @@ def setup_render(scene):
     scene.view_settings.view_transform = 'Filmic'
     scene.view_settings.look = 'Filmic - Medium High Contrast'
 
-    scene.render.filepath = '//render.jpg'
     scene.render.image_settings.file_format = 'JPEG'
     scene.render.image_settings.color_mode = 'RGB'
 
@@ -217,21 +443,148 @@ def setup_compositing(scene):
                    comp_nodes['Composite'].inputs['Image'])
 
 
-if __name__ == "__main__":
+def setup_preview(scene):
+    """Lower samples and skip compositing for quick test renders."""
+
+    scene.cycles.samples = 16
+    scene.cycles.preview_samples = 16
+
+    scene.use_nodes = False
+
+
+def template_is_current(template):
+    """Return True if the template exists and is newer than this script."""
+
+    return (os.path.isfile(template) and
+            os.path.getmtime(template) >= os.path.getmtime(__file__))
+
+
+def load_template(template):
+    """Open the template file, or build the scene and save it as one.
+
+    Returns the scene to use, since opening a file replaces the current one.
+    """
+
+    if template_is_current(template):
+        print('- Opening template: {}'.format(template))
+        bpy.ops.wm.open_mainfile(filepath=template)
+        return bpy.context.scene
 
-    filepath = path('assets', 'objects', 'pumpkin', 'pumpkin.obj')
     scene = bpy.context.scene
 
     setup_scene(scene)
     setup_render(scene)
     setup_compositing(scene)
 
+    print('- Saving template: {}'.format(template))
+    bpy.ops.wm.save_as_mainfile(filepath=template)
+
+    return scene
+
+
+def render_batch(asset_paths):
+    """Render each asset in its own background Blender process.
+
+    Uses half of the CPUs as workers and splits Cycles' render threads
+    between them so they don't oversubscribe the machine. Returns the number
+    of assets that failed.
+    """
+
+    cpus = os.cpu_count() or 1
+    workers = max(1, min(cpus // 2, len(asset_paths)))
+    threads = max(1, cpus // workers)
+
+    # Give every asset its own output, even if the names are the same
+    outputs = []
+    for asset_path in asset_paths:
+        name = os.path.splitext(os.path.basename(asset_path))[0]
+        output, number = name + '.jpg', 1
+        while output in outputs:
+            number += 1
+            output = '{}_{}.jpg'.format(name, number)
+        outputs.append(output)
+
+    def render(asset_path, output):
+        print('- Rendering {} to {}'.format(asset_path, output))
+        env = dict(os.environ, BLENDER_OUTPUT=output)
+        return subprocess.call([bpy.app.binary_path, '-b',
+                                '-t', str(threads),
+                                '--python-exit-code', '1',
+                                '-P', os.path.abspath(__file__),
+                                '--', asset_path], env=env)
+
+    # Threads are enough here, the work happens in the Blender processes
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(render, asset_paths, outputs)
+
+        failures = 0
+        for asset_path, returncode in zip(asset_paths, results):
+            if returncode != 0:
+                print('[!] Failed to render {}!'.format(asset_path))
+                failures += 1
+
+    return failures
+
+
+if __name__ == "__main__":
+
+    filepath = path('assets', 'objects', 'pumpkin', 'pumpkin.obj')
+    preview = os.environ.get('BLENDER_PREVIEW') == '1'
+
+    # Assets to render are passed after "--" so Blender ignores them
+    asset_paths = []
+    if '--' in sys.argv:
+        asset_paths = [os.path.abspath(asset_path) for asset_path
+                       in sys.argv[sys.argv.index('--') + 1:]]
+
+    if bpy.app.background and len(asset_paths) > 1:
+        # Make sure the template exists before the workers race to save it
+        if not template_is_current(path('template.blend')):
+            load_template(path('template.blend'))
+        sys.exit(1 if render_batch(asset_paths) else 0)
+
+    if len(asset_paths) > 1:
+        print('[!] Only importing {} in the UI'.format(asset_paths[0]))
+
+    if asset_paths:
+        filepath = asset_paths[0]
+
+    if bpy.app.background:
+        scene = load_template(path('template.blend'))
+    else:
+        # Keep the open file in the UI, just rebuild the setup
+        scene = bpy.context.scene
+        setup_scene(scene)
+        setup_render(scene)
+
+        # Previews don't use the compositor, don't add to its nodes
+        if not preview:
+            setup_compositing(scene)
+
+    if preview:
+        setup_preview(scene)
+
+    # Use an absolute path, '//' would depend on whether a file is open
+    output = 'render.jpg'
+    if asset_paths:
+        output = os.path.splitext(os.path.basename(filepath))[0] + '.jpg'
+    scene.render.filepath = path(os.environ.get('BLENDER_OUTPUT', output))
+
+    failed = False
     try:
         pumpkin = Asset(filepath)
-    except (RuntimeError, FileNotFoundError):
+    except FileNotFoundError:
         print('[!] Can\'t find file {}!'.format(filepath))
+        failed = True
+    except RuntimeError as error:
+        print('[!] Can\'t import file {}: {}'.format(filepath, error))
+        failed = True
 
     if bpy.app.background:
+        # Report the failure to render_batch instead of rendering the table
+        if failed:
+            sys.exit(1)
+
         # Only render if called from the command line (makes
         # testing easier)
         bpy.ops.render.render(write_still=True)
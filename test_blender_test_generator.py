@@ -0,0 +1,46 @@
+import os
+
+import blender_test_generator as generator
+
+
+def make_files(folder, *names):
+    for name in names:
+        folder.join(name).write('')
+
+
+def test_find_textures(tmpdir):
+    make_files(tmpdir, 'pumpkin.obj', 'pumpkin.jpg', 'pumpkin_ao.jpg',
+               'pumpkins.jpg', 'floor.jpg', 'pumpkin_cavity.png')
+
+    textures = generator.find_textures(str(tmpdir), 'pumpkin')
+
+    assert textures == {
+        'diffuse': os.path.join(str(tmpdir), 'pumpkin.jpg'),
+        'ao': os.path.join(str(tmpdir), 'pumpkin_ao.jpg'),
+    }
+
+
+def test_find_textures_skips_unused_maps(tmpdir):
+    make_files(tmpdir, 'pumpkin.jpg', 'pumpkin_roughness.jpg')
+
+    textures = generator.find_textures(str(tmpdir), 'pumpkin')
+
+    assert set(textures) == {'diffuse'}
+
+
+def test_find_textures_with_underscore_name(tmpdir):
+    make_files(tmpdir, 'wooden_chair.jpg', 'wooden_chair_AO.JPG',
+               'wooden.jpg')
+
+    textures = generator.find_textures(str(tmpdir), 'wooden_chair')
+
+    assert textures == {
+        'diffuse': os.path.join(str(tmpdir), 'wooden_chair.jpg'),
+        'ao': os.path.join(str(tmpdir), 'wooden_chair_AO.JPG'),
+    }
+
+
+def test_find_textures_none_found(tmpdir):
+    make_files(tmpdir, 'pumpkins.jpg', 'floor.jpg')
+
+    assert generator.find_textures(str(tmpdir), 'pumpkin') == {}